@@ -52,10 +52,33 @@ RETURN = """
 """
 
 import os
+import atexit
 import json
 import re
+import stat
 import requests
 import base64
+import binascii
+import hashlib
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+try:
+    import ijson
+    _JSON_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _JSON_ERRORS = (ValueError,)
 
 from ansible.errors import AnsibleError, AnsibleParserError
 from ansible.plugins.lookup import LookupBase
@@ -67,12 +90,73 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+RC_FILE = os.path.expanduser('~/.storedsafe-client.rc')
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+MAX_CONNECT_RETRIES = 2
+B64_CHUNK = 8192 # must be a multiple of 4
+AUTH_CACHE_TTL = 60
+_TOKEN_RE = re.compile(r'^token:([a-zA-Z0-9]+)$')
+_SITE_RE = re.compile(r'^mysite:([-a-zA-Z0-9_.]+)$')
+_EXPIRES_RE = re.compile(r'^expires:([0-9]+(?:\.[0-9]*)?)$')
+
+# (rc file path, mtime) -> parsed (server, token, expires)
+_RC_CACHE = {}
+
+# sha256(url + token) -> monotonic time until which the token is considered valid
+_AUTH_CACHE = {}
+
+def _auth_cache_key(url, token):
+    return hashlib.sha256((url + token).encode('utf-8')).hexdigest()
+
+# (skipverify, cabundle) -> Session shared by all lookups in this process
+_SESSIONS = {}
+
+# Ansible forks a worker per task; a forked child must not reuse the
+# parent's pooled sockets, so it starts over with fresh sessions.
+os.register_at_fork(after_in_child=_SESSIONS.clear)
+
+def _build_session():
+    session = requests.Session()
+    # Only transient failures (dropped connections, 5xx answers) are retried with
+    # backoff by urllib3; TLS verification and other errors fail immediately
+    retry = Retry(total=MAX_RETRIES, connect=MAX_CONNECT_RETRIES, read=MAX_CONNECT_RETRIES, other=0,
+                  status=MAX_RETRIES, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                  allowed_methods=['GET', 'POST'], raise_on_status=False)
+    session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=4,
+                                          pool_maxsize=MAX_WORKERS))
+    return session
+
+@atexit.register
+def _close_sessions():
+    for session in _SESSIONS.values():
+        session.close()
+
+def _b64decode(encoded):
+    out = bytearray(len(encoded) * 3 // 4)
+    pos = 0
+    try:
+        for i in range(0, len(encoded), B64_CHUNK):
+            chunk = base64.decodebytes(encoded[i:i + B64_CHUNK].encode('ascii'))
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    except binascii.Error:
+        # Whitespace or other stray characters broke the 4 character
+        # alignment of the chunks; decode it in one go instead
+        return base64.b64decode(encoded)
+    del out[pos:]
+    return bytes(out)
+
 class LookupModule(LookupBase):
 
     def run(self, terms, variables=None, **kwargs):
 
         result = []
-        display.vvvv(u"StoredSafe lookup initial terms is %s" % (terms))
+        # Skip building debug messages unless running with -vvvv
+        verbose = display.verbosity >= 4
+        log = display.vvvv
+        if verbose:
+            log(u"StoredSafe lookup initial terms is %s" % (terms))
 
         cabundle = os.getenv('STOREDSAFE_CABUNDLE') or variables.get('storedsafe_cabundle')
         skipverify = ((os.getenv('STOREDSAFE_SKIP_VERIFY') in ['1', 'true', 'True', 't']) or
@@ -80,116 +164,168 @@ class LookupModule(LookupBase):
 
         server = os.getenv('STOREDSAFE_SERVER') or variables.get('storedsafe_server')
         token = os.getenv('STOREDSAFE_TOKEN')
+        expires = False
 
         if not server:
-            (server, token) = self._read_rc(os.path.expanduser('~/.storedsafe-client.rc'))
+            (server, token, expires) = self._read_rc(RC_FILE)
             if not server:
                 raise AnsibleError('StoredSafe address not set. Specify with'
                                    ' STOREDSAFE_SERVER environment variable, storedsafe_server Ansible variable'
-                                   ' or specified in the %s' % os.path.expanduser('~/.storedsafe-client.rc'))
+                                   ' or specified in the %s' % RC_FILE)
         if not token:
             raise AnsibleError('StoredSafe token not set. Specify with'
                                ' STOREDSAFE_TOKEN environment variable'
-                               ' or specify in the %s' % os.path.expanduser('~/.storedsafe-client.rc'))
-            
+                               ' or specify in the %s' % RC_FILE)
+
+        key = (bool(skipverify), cabundle)
+        if key not in _SESSIONS:
+            _SESSIONS[key] = _build_session()
+        self._session = _SESSIONS[key]
+        # Passed on every call: REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE would override Session.verify
+        self._verify = False if skipverify else (cabundle or True)
+
+        url = "https://" + server + "/api/1.0"
+        self._object_url = url + '/object/'
+        self._base_payload = { 'token': token, 'decrypt': 'true' }
+        # A token from the rc file with a known, future expiry needs no /auth/check
+        if expires and expires > time.time():
+            _AUTH_CACHE[_auth_cache_key(url, token)] = time.monotonic() + expires - time.time()
         try:
-            url = "https://" + server + "/api/1.0"
-            self._auth_check(url, token, cabundle, skipverify)
-        except:
-            raise AnsibleError('Not logged in to StoredSafe.')
-
-        for term in terms:
-            term_split = term.split('/', 1)
-            objectid = term_split[0]
-            fieldname = term_split[1]
-            display.vvvv(u"StoredSafe lookup using %s/%s" % (objectid, fieldname))
+            self._auth_check(url, token)
+        except _JSON_ERRORS + (KeyError, TypeError) as e:
+            raise AnsibleError('Not logged in to StoredSafe.') from e
+
+        # Group fields by object so every object is only fetched once
+        lookups = [term.split('/', 1) for term in terms]
+        fields = defaultdict(list)
+        for (objectid, fieldname) in lookups:
+            fields[objectid].append(fieldname)
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = dict((objectid, executor.submit(self._get_object, url, token, objectid,
+                                                      'download' in fields[objectid]))
+                           for objectid in fields)
+            self._object_cache = {}
+            for (objectid, future) in futures.items():
+                try:
+                    self._object_cache[objectid] = future.result()
+                # ijson reads req.raw directly, where urllib3 errors are not wrapped by requests
+                except (requests.RequestException, Urllib3HTTPError) + _JSON_ERRORS as e:
+                    raise AnsibleError('Failed to retreive information from StoredSafe.') from e
 
-            try:
-                item = self._get_item(url, token, objectid, fieldname, cabundle, skipverify)
-                result.append(item.rstrip())
-            except:
-                raise AnsibleError('Failed to retreive information from StoredSafe.')
+        for (objectid, fieldname) in lookups:
+            if verbose:
+                log(u"StoredSafe lookup using %s/%s" % (objectid, fieldname))
+            item = self._get_item(self._object_cache[objectid], fieldname)
+            result.append(item.rstrip())
 
         return result
 
-    def _get_item(self, url, token, objectid, fieldname, cabundle, skipverify):
-        item = False
-        payload = { 'token': token, 'decrypt': 'true' }
-        if fieldname == 'download':
-            payload['filedata'] = 'true'
+    def _get_object(self, url, token, objectid, download):
+        payload = self._base_payload
+        if download:
+            payload = dict(payload, filedata='true')
             display.vvvv(u"StoredSafe will try to download file content.")
-        if skipverify:
-            req = requests.get(url + '/object/' + objectid, params=payload, verify=False)
-        elif cabundle:
-            req = requests.get(url + '/object/' + objectid, params=payload, verify=cabundle)
-        else:
-            req = requests.get(url + '/object/' + objectid, params=payload)
-        data = json.loads(req.content)
-        if not req.ok:
-            raise AnsibleError('Failed to communicate with StoredSafe.')
+        with self._session.get(self._object_url + objectid, params=payload, stream=download,
+                               verify=self._verify) as req:
+            if req.status_code in (401, 403):
+                _AUTH_CACHE.pop(_auth_cache_key(url, token), None)
+                raise AnsibleError('Not logged in to StoredSafe.')
+            if not req.ok:
+                raise AnsibleError('Failed to communicate with StoredSafe.')
+
+            if not download:
+                return _loads(req.content)
+
+            if ijson:
+                # Parse the body as it arrives, so the encoded file is never
+                # held both as raw response bytes and as a parsed string.
+                req.raw.decode_content = True
+                data = dict(ijson.kvitems(req.raw, '', use_float=True))
+            else:
+                data = _loads(req.content)
+        if data.get('FILEDATA'):
+            data['FILEDATA'] = _b64decode(data['FILEDATA'])
+        return data
 
+    def _get_item(self, data, fieldname):
+        item = False
         if 'OBJECT' in data:
             if (len(data['OBJECT'])): # Unless result is empty
-                try:
-                    item = data['OBJECT'][0]["crypted"][fieldname]
-                except:
-                    try:
-                        item = data['OBJECT'][0]["public"][fieldname]
-                    except:
-                        try:
-                            item = data['OBJECT'][0][fieldname]
-                        except:
-                            item = False
+                obj = data['OBJECT'][0]
+                # Empty "crypted"/"public" sections are sent as [] rather than {}
+                item = ((obj.get('crypted') or {}).get(fieldname) or
+                        (obj.get('public') or {}).get(fieldname) or
+                        obj.get(fieldname))
 
             if fieldname == 'download':
                 if 'FILEDATA' in data:
                     if (len(data['FILEDATA'])):
-                        item = base64.b64decode(data['FILEDATA'])
+                        item = data['FILEDATA']
                         display.vvvv(u"StoredSafe returning base64 decoded file content.")
 
         if not item:
             raise AnsibleError('Could not find the requested information in StoredSafe.')
 
-        return to_text(item)
+        # Only downloaded file content (bytes) and non-string fields need converting
+        return item if isinstance(item, str) else to_text(item)
 
     def _read_rc(self, rc_file):
-        if os.path.isfile(rc_file):
-            _file = open(rc_file, 'rU')
+        try:
+            st = os.stat(rc_file)
+        except OSError:
+            return (False, False, False)
+        if not stat.S_ISREG(st.st_mode):
+            return (False, False, False)
+        key = (rc_file, st.st_mtime_ns)
+        if key not in _RC_CACHE:
+            _RC_CACHE.clear()
+            _RC_CACHE[key] = self._parse_rc(rc_file)
+        return _RC_CACHE[key]
+
+    def _parse_rc(self, rc_file):
+        token = server = expires = False
+        with open(rc_file, 'r') as _file:
             for line in _file:
-                if "token" in line:
-                    token = re.sub('token:([a-zA-Z0-9]+)\n$', r'\1', line)
+                line = line.rstrip()
+                m = _TOKEN_RE.match(line)
+                if m:
+                    token = m.group(1)
                     if token == 'none':
-                        return (False, False)
-                if "mysite" in line:
-                    server = re.sub('mysite:([-a-zA-Z0-9_.]+)\n$', r'\1', line)
+                        return (False, False, False)
+                    continue
+                m = _SITE_RE.match(line)
+                if m:
+                    server = m.group(1)
                     if server == 'none':
-                        return (False, False)
-            _file.close()
-            if not token:
-                return (False, False)
-            if not server:
-                return (False, False)
-            return (server, token)
-        else:
-            return (False, False)
+                        return (False, False, False)
+                    continue
+                m = _EXPIRES_RE.match(line)
+                if m:
+                    expires = float(m.group(1))
+        if not token:
+            return (False, False, False)
+        if not server:
+            return (False, False, False)
+        return (server, token, expires)
+
+    def _auth_check(self, url, token):
+        key = _auth_cache_key(url, token)
+        if _AUTH_CACHE.get(key, 0) > time.monotonic():
+            return True
 
-    def _auth_check(self, url, token, cabundle, skipverify):
-        payload = { 'token': token }
         try:
-            if skipverify:
-                req = requests.post(url + '/auth/check', data=json.dumps(payload), verify=False)
-            elif cabundle:
-                req = requests.post(url + '/auth/check', data=json.dumps(payload), verify=cabundle)
-            else:
-                req = requests.post(url + '/auth/check', data=json.dumps(payload))
-        except:
-            raise AnsibleError('ERROR: Can not reach "%s"' % url)
+            req = self._session.post(url + '/auth/check', headers={ 'X-Http-Token': token },
+                                     verify=self._verify)
+        except requests.RequestException as e:
+            raise AnsibleError('ERROR: Can not reach "%s"' % url) from e
 
         if not req.ok:
             raise AnsibleError('Not logged in to StoredSafe.')
 
-        data = json.loads(req.content)
+        data = _loads(req.content)
         if data['CALLINFO']['status'] != 'SUCCESS':
             raise AnsibleError('ERROR: Session not authenticated with server. Token invalid?')
 
+        _AUTH_CACHE[key] = time.monotonic() + AUTH_CACHE_TTL
         return True